@@ -32,6 +32,7 @@
 # basic things:
 
 import os             # for file and directory stuff, like os.path.isfile()
+import stat           # for stat.S_ISREG(), to check results from os.stat()
 import socket         # for socket stuff
 import sys            # for sys.argv and sys.exit()
 import urllib.parse   # for urllib.parse.unquote() and urllib.parse.unquote_plus()
@@ -39,7 +40,10 @@ import time           # for time of day and date functions
 import threading      # for concurrent threads and locks
 import random         # for random numbers
 import re             # for regex split() to split up strings
-import string         # for various string operations
+import queue          # for a queue of connections waiting to be handled
+import mimetypes      # for guessing the mime type of a file from its name
+import collections    # for OrderedDict, used to keep track of cached files
+import atexit         # for stopping the logging thread when the program exits
 
 # Global configuration variables.
 # These never change once the server has finished initializing, so they don't
@@ -47,28 +51,36 @@ import string         # for various string operations
 server_host = None # e.g. localhost, 127.0.0.1, logos.holycross.edu, or similar
 server_port = None # e.g. 8888 or similar
 server_root = "./web_root"
+server_root_abs = None # absolute path of server_root, ending with a slash
 server_ip = None
 
 
 # Global variables to keep track of statistics, with initial values. These get
 # updated by different connection handler threads. To avoid concurrency
-# problems, these must only be accessed within a "with" block, like this:
+# problems, these must only be accessed within a "with" block, using the lock
+# that protects that particular variable, like this:
 #     x = ...
 #     with stats.lock:
 #        stats.tot_time += x
 #        if x > stats.max_time:
 #            stats.max_time = x
 #        ...
+# Using several small locks, rather than one lock for everything, means threads
+# updating unrelated counters don't have to wait for each other. Code that needs
+# a consistent snapshot of everything (like the /status page) should acquire all
+# of the locks, always in the order: conn_lock, lock, errors_lock.
 class Statistics:
     def __init__(self):
-        self.lock = threading.Condition() # protects all variables below 
+        self.conn_lock = threading.Lock() # protects the two variables below
         self.total_connections = 0
         self.active_connections = 0
+        self.lock = threading.Condition() # protects the four variables below
         self.num_requests = 0
-        self.num_errors = 0
         self.max_time = 0 # max time spent handling a request
         self.tot_time = 0 # total time spent handling requests
         self.avg_time = 0 # average time spent handling requests
+        self.errors_lock = threading.Lock() # protects the variable below
+        self.num_errors = 0
 stats = Statistics()
 
 
@@ -80,8 +92,9 @@ class Request:
         self.path = ""    # url path for this request
         self.version = "" # http version for this request
         self.headers = [] # headers from client for this request
+        self.header_map = {} # same headers, as a dict with lower-case keys
         self.length = 0   # length of the request body, if any
-        self.body = None  # contents of the request body, if any
+        self.body = None  # contents of the request body (as bytes), if any
 
 
 # Response objects are used to hold information associated with a single HTTP
@@ -89,13 +102,16 @@ class Request:
 # something like "200 OK" or "404 NOT FOUND". The mime_type and body are
 # optional. If present, the mime_type should be something like "text/plain" or
 # "image/png", and the body should be a string or bytes object containing
-# contents appropriate for that mime type.
+# contents appropriate for that mime type. Alternatively, the body can be a file
+# that has been opened in "rb" mode, if send_as_file is set to True. In that
+# case, the contents of the file are sent, and the file is closed afterwards.
 class Response:
     def __init__(self, code, mime_type=None, body=None):
         self.code = code             # example: "200 OK"
         self.mime_type = mime_type   # example: "image.png"
-        self.body = body             # a bytes object, or a string
+        self.body = body             # bytes, a string, or an open file
         self.cookies = None          # a list of name=value strings (optional)
+        self.send_as_file = False    # True if body is an open file
 
 
 # Helper function to check if a string looks like a common IPv4 address. Note:
@@ -122,120 +138,188 @@ ERR_SOCKET_HAD_TIMEOUT = SocketError("Read Timeout")
 ERR_SOCKET_HAD_ERROR = SocketError("Read/Write Failure")
 
 # This variable controls how long the server is willing to wait for data from a
-# client. If set to None, the server will wait indefinitely.
-SOCKET_TIMEOUT = None # Or use 10.0 to give up after 10 seconds waiting for data from client.
+# client, or for a client to accept data being sent to it. If set to None, the
+# server will wait indefinitely. Since each connection occupies a worker thread
+# while it waits (see NUM_WORKER_THREADS below), this should not be None.
+SOCKET_TIMEOUT = 10.0 # give up after 10 seconds waiting for the client.
+
+# This variable controls how long the server will keep a connection open while
+# waiting for the client to send a request, either the first request on a new
+# connection or another request after handling the previous one.
+KEEP_ALIVE_TIMEOUT = 10.0
 
 # Connection objects are used to hold information associated with a single HTTP
 # connection, like the socket for the connection, the client's IP address,
 # statistics specific to that connection, any leftover data from the client that
-# hasn't yet been processed, etc.
+# hasn't yet been processed, etc. The times are from time.monotonic(), which
+# is only useful for measuring elapsed time, and "now" should be the current
+# time when the connection was established.
 class Connection:
-    def __init__(self, connected_socket, addr):
+    def __init__(self, connected_socket, addr, now):
         self.sock = connected_socket        # the socket connected to the client
         self.client_addr = addr             # IP address of the client
-        self.leftover_data = b""            # data from client, not yet processed
+        self.leftover_data = bytearray()    # data from client, not yet processed
         self.num_requests = 0               # number of requests from client handled so far
-        self.start_time = time.time()       # time connection was established
-        self.last_active_time = time.time() # time connection was last used
+        self.start_time = now               # time connection was established
+        self.last_active_time = now         # time connection was last used
+        self.should_close = False           # True if no more requests should be handled
+        self.keep_alive_header = False      # True if HTTP/1.0 keep-alive was requested
 
     # wait_until_data_arrives() examines the socket and waits until some data
-    # has arrived from the client. Normally, this function returns None, but if
-    # something goes wrong, this function instead returns:
+    # has arrived from the client. The optional timeout parameter says how many
+    # seconds to wait, and defaults to SOCKET_TIMEOUT. Normally, this function
+    # returns None, but if something goes wrong, this function instead returns:
     # - ERR_SOCKET_HAD_TIMEOUT if a timeout occurs before data arrives,
     # - ERR_SOCKET_WAS_CLOSED if the socket was closed before any data arrives,
     # - ERR_SOCKET_HAD_ERROR if some other error is encountered.
-    def wait_until_data_arrives(self):
+    def wait_until_data_arrives(self, timeout=SOCKET_TIMEOUT):
         if len(self.leftover_data) > 0:
             return None
         try:
             # Set the timeout value, if present, to prevent infinite waiting.
-            if SOCKET_TIMEOUT is not None:
-                self.sock.settimeout(SOCKET_TIMEOUT)
+            if timeout is not None:
+                self.sock.settimeout(timeout)
             # Read (up to) another 4KB of data from the client
             more_data = self.sock.recv(4096)
             if not more_data: # Connection has died?
-                log("Client %s closed the socket." % (self.client_addr))
+                log("Client %s closed the socket.", self.client_addr)
                 return ERR_SOCKET_WAS_CLOSED
-            self.leftover_data = self.leftover_data + more_data
+            self.leftover_data.extend(more_data)
             return None
-        except socket.timeout as err:
-            log("Client %s has not sent data in %s seconds." %
-                (self.client_addr, SOCKET_TIMEOUT))
-            return ERR_SOCKET_HAD_TIMEOUT
-        except:
-            log("Error reading from client %s socket" % (self.client_addr))
+        except OSError as err:
+            if isinstance(err, socket.timeout):
+                log("Client %s has not sent data in %s seconds.",
+                    self.client_addr, timeout)
+                return ERR_SOCKET_HAD_TIMEOUT
+            log("Error reading from client %s socket: %s", self.client_addr, err)
             return ERR_SOCKET_HAD_ERROR
         finally:
             # Remove timeout, if present, so future operations are unaffected.
-            if SOCKET_TIMEOUT is not None:
+            if timeout is not None:
                 self.sock.settimeout(None)
 
     # read_until_blank_line() returns data from the client up to (but not
-    # including) the next blank line, i.e. "\r\n\r\n". The "\r\n\r\n" sequence
-    # is discarded. Any leftovers after the blank line is saved for later. This
-    # function returns one of the ERR_SOCKET values if an error is encountered.
+    # including) the next blank line, i.e. "\r\n\r\n", as a bytes object. The
+    # "\r\n\r\n" sequence is discarded. Any leftovers after the blank line is
+    # saved for later. This function returns one of the ERR_SOCKET values if an
+    # error is encountered. The leftover_data bytearray is extended in place as
+    # data arrives, and only the newly arrived part (plus 3 bytes of overlap) is
+    # searched each time, so even a client that sends one byte at a time doesn't
+    # cause repeated copies.
     def read_until_blank_line(self):
-        data = self.leftover_data
+        data = self.leftover_data # anything not used is saved here for later
         try:
             # Set the timeout value, if present, to prevent infinite waiting.
             if SOCKET_TIMEOUT is not None:
                 self.sock.settimeout(SOCKET_TIMEOUT)
-            # Keep reading until we get a blank line.
-            while b"\r\n\r\n" not in data:
+            # Keep reading until we get a blank line. The methods used in the
+            # loop are looked up once, here, rather than every time around.
+            find = data.find
+            extend = data.extend
+            recv = self.sock.recv
+            scan_from = 0
+            while True:
+                idx = find(b"\r\n\r\n", max(0, scan_from - 3))
+                if idx != -1:
+                    break
+                scan_from = len(data)
                 # Read (up to) another 4KB of data from the client
-                more_data = self.sock.recv(4096)
+                more_data = recv(4096)
                 if not more_data: # Connection has died?
-                    log("Client %s closed the socket." % (self.client_addr))
-                    self.leftover_data = data # save it all for later?
+                    log("Client %s closed the socket.", self.client_addr)
                     return ERR_SOCKET_WAS_CLOSED
-                data = data + more_data
+                extend(more_data)
             # The part we want is everything up to the first blank line.
-            data, self.leftover_data = data.split(b"\r\n\r\n", 1)
-            return data.decode()
-        except socket.timeout as err:
-            log("Client %s has not sent data in %s seconds." %
-                (self.client_addr, SOCKET_TIMEOUT))
-            self.leftover_data = data # save it all for later?
-            return ERR_SOCKET_HAD_TIMEOUT
-        except:
-            log("Error reading from client %s socket" % (self.client_addr))
-            self.leftover_data = data # save it all for later?
+            header_data = bytes(data[:idx])
+            del data[:idx+4]
+            return header_data
+        except OSError as err:
+            if isinstance(err, socket.timeout):
+                log("Client %s has not sent data in %s seconds.",
+                    self.client_addr, SOCKET_TIMEOUT)
+                return ERR_SOCKET_HAD_TIMEOUT
+            log("Error reading from client %s socket: %s", self.client_addr, err)
             return ERR_SOCKET_HAD_ERROR
         finally:
             # Remove timeout, if present, so future operations are unaffected.
             if SOCKET_TIMEOUT is not None:
                 self.sock.settimeout(None)
 
-    # read_amount(n) returns the next n bytes of data from the client. Any
-    # leftovers after the n bytes are saved for later. This function returns
-    # None if an error is encountered. It does not use timeouts, but instead
-    # will wait indefinitely for enough data to arrive.
+    # read_amount(n) returns the next n bytes of data from the client, as a bytes
+    # object, since the data might not be text at all (e.g. an uploaded image).
+    # Any leftovers after the n bytes are saved for later. This function returns
+    # None if an error is encountered, including if the client sends nothing for
+    # more than SOCKET_TIMEOUT seconds.
     def read_amount(self, n):
-        data = self.leftover_data
+        data = self.leftover_data # anything not used is saved here for later
         try:
+            # Set the timeout value, if present, to prevent infinite waiting.
+            if SOCKET_TIMEOUT is not None:
+                self.sock.settimeout(SOCKET_TIMEOUT)
             while len(data) < n:
                 more_data = self.sock.recv(n - len(data))
                 if not more_data: # Connection has died?
-                    self.leftover_data = data # save it all for later
                     return None
-                data = data + more_data
+                data.extend(more_data)
             # The part we want is the first n bytes.
-            data, self.leftover_data = (data[0:n], data[n:])
-            return data.decode()
-        except:
-            log("Error reading from client %s socket" % (self.client_addr))
-            self.leftover_data = data # save it all for later
+            body = bytes(data[:n])
+            del data[:n]
+            return body
+        except OSError as err:
+            log("Error reading from client %s socket: %s", self.client_addr, err)
             return None
+        finally:
+            # Remove timeout, if present, so future operations are unaffected.
+            if SOCKET_TIMEOUT is not None:
+                self.sock.settimeout(None)
 
 
+# This variable controls how much gets logged. At level 0, nothing is logged.
+# At level 1, the normal trace of activity is logged, including the headers of
+# each request and response. At level 2, response bodies are logged as well.
+LOG_LEVEL = 1
+
+# Rather than having every thread print directly to standard output, which
+# would make them all compete to use the console, log messages are put into a
+# queue, and a single logging thread takes them from the queue and prints them.
+# A None in the queue tells the logging thread to stop.
+log_queue = queue.SimpleQueue()
+
+# print_log_messages() is run by the logging thread, which should be started
+# before anything is logged. stop_logging() stops the logging thread, and waits
+# for it to print any remaining messages.
+def print_log_messages():
+    while True:
+        msg = log_queue.get()
+        if msg is None:
+            break
+        sys.stdout.write(msg)
+        if log_queue.empty(): # no more messages right now, so show them all
+            sys.stdout.flush()
+    sys.stdout.flush()
+
+def stop_logging():
+    log_queue.put(None)
+    log_thread.join()
+
 # log(msg) prints a message to standard output. Since multi-threading can jumble
 # up the order of output on the screen, we print out the current thread's name
-# on each line of output along with the message.
+# on each line of output along with the message. The message is only printed if
+# the level is no more than LOG_LEVEL. The message is formatted here, by the
+# calling thread, then handed off to the logging thread to be printed.
 # Example usage:
 #   log("Hello %s, you are customer number %d, have a nice day!" % (name, n))
 # You can also use python's f-strings instead of the modulo operator:
 #   log(f"Hello {name}, you are customer number {n}, have a nice day!")
-def log(msg):
+# Or you can pass the values as extra arguments, in which case the formatting
+# is skipped entirely if the message isn't going to be printed:
+#   log("Hello %s, you are customer number %d, have a nice day!", name, n)
+#   log("Some verbose details: %s", details, level=2)
+def log(msg, *args, level=1):
+    if level > LOG_LEVEL:
+        return
+    if len(args) > 0:
+        msg = msg % args
     # Convert msg to a string, if it is not already
     if not isinstance(msg, str):
         msg = str(msg)
@@ -248,7 +332,7 @@ def log(msg):
     lines = msg.splitlines()
     msg = linebreak.join(lines)
     # Print it all out, prefixed by this thread's name.
-    print(myname + ": " + msg)
+    log_queue.put(myname + ": " + msg + "\n")
 
 
 # get_header_value() finds a specific header value from within a list of header
@@ -256,15 +340,21 @@ def log(msg):
 # The headers list comes from an HTTP request sent from the client. The key
 # should usually be a standard HTTP header, like "Content-Type",
 # "Content-Length", "Connection", etc. This will properly handle upper-case,
-# lower-case, and mixed-case header names.
+# lower-case, and mixed-case header names. Instead of a list of headers, you can
+# also pass in the Request object itself, in which case the value is looked up
+# in the request's header_map dict, which is much faster than searching a list.
 def get_header_value(headers, key):
+    if isinstance(headers, Request):
+        return headers.header_map.get(key.lower())
+    prefix = key.lower() + ": "
     for hdr in headers:
-        if hdr.lower().startswith(key.lower() + ": "):
+        if hdr.lower().startswith(prefix):
             val = hdr.split(" ", 1)[1]
             return val
     return None
 
 # get_cookies() returns the entire "Cookie" header, or None if it's not present.
+# Like get_header_value(), this accepts either a list of headers or a Request.
 def get_cookies(headers):
     vals = get_header_value(headers, "Cookie")
     return vals
@@ -299,66 +389,97 @@ def get_cookie(headers, name):
 
 # make_printable() does some substitutions on a string so that it prints nicely
 # on the console while still showing unprintable characters (like "\r" or "\n")
-# in a sensible way.
-printable = string.ascii_letters + string.digits + string.punctuation + " \r\n\t"
+# in a sensible way. All the substitutions are done by a single call to
+# str.translate(), using a table that is built once, when the server starts,
+# rather than by looping over the string one character at a time.
+# The table has an entry for each of the first 256 characters: the ordinary
+# printable ASCII characters, from " " (0x20) up to "~" (0x7e), map to
+# themselves, and everything else maps to an escape sequence like "\x07".
+class EscapeTable(dict):
+    # Characters beyond the first 256 are rare, so they are escaped on demand
+    # rather than stored in the table.
+    def __missing__(self, c):
+        return r'\x{0:02x}'.format(c)
+escape_table = EscapeTable()
+for c in range(256):
+    if 0x20 <= c <= 0x7e:
+        escape_table[c] = chr(c)
+    else:
+        escape_table[c] = r'\x{0:02x}'.format(c)
+escape_table[ord("\n")] = "\\n\n"
+escape_table[ord("\r")] = "\\r"
+escape_table[ord("\t")] = "\\t"
 def make_printable(s):
     if isinstance(s, bytes):      # if s is raw binary...
         try:
             s = s.decode()
-        except:
+        except UnicodeDecodeError:
             return "{binary data, %d bytes total, not shown here}\n" % (len(s))
     if not isinstance(s, str):  # if s is not a string...
-        body = str(s)             # ... convert to string
-    s = s.replace("\n", "\\n\n")
-    s = s.replace("\r", "\\r")
-    s = s.replace("\t", "\\t")
-    return ''.join(c if c in printable else r'\x{0:02x}'.format(ord(c)) for c in s)
+        s = str(s)                # ... convert to string
+    return s.translate(escape_table)
 
 # handle_one_http_request() reads one HTTP request from the client, parses it,
 # decides what to do with it, then sends an appropriate response back to the
-# client. 
+# client. This returns True if a request was handled, or False if no request
+# could be read from the client at all. If the connection should be closed after
+# this request, conn.should_close is set to True.
 def handle_one_http_request(conn):
     # The HTTP request is everything up to the first blank line
     data = conn.read_until_blank_line()
     if data == ERR_SOCKET_WAS_CLOSED:
         # Client disconnected... that's fine, nothing more to do here.
-        return # caller will close socket
+        return False # caller will close socket
     if data == ERR_SOCKET_HAD_TIMEOUT:
         # Client is not sending requests... let's close the connection.
-        log("Connection has been idle more than %s seconds, closing immediately.")
-        return # caller will close socket
+        log("Connection has been idle more than %s seconds, closing immediately.",
+            SOCKET_TIMEOUT)
+        return False # caller will close socket
     if data == ERR_SOCKET_HAD_ERROR:
         # Unknown error... let's close the connection.
-        return # caller will close socket
+        return False # caller will close socket
 
-    conn.last_active_time = time.time()
-
-    log("Request %d has arrived...\n%s" %
-        (conn.num_requests, make_printable(data+"\r\n\r\n")))
+    if LOG_LEVEL >= 1:
+        log("Request %d has arrived...\n%s",
+            conn.num_requests, make_printable(data+b"\r\n\r\n"))
 
     # Make a Request object to hold all the info about this request
     req = Request()
 
-    # The first line is the request-line, the rest is the headers.
+    # The first line is the request-line, the rest is the headers. The data is
+    # still raw bytes at this point, and each piece is only converted to a
+    # string once it has been split out. The headers are converted using the
+    # "latin-1" encoding, which is what HTTP uses for headers, and which can't
+    # fail no matter what bytes the client sent.
     lines = data.splitlines()
     if len(lines) == 0:
         log("Request is missing the required HTTP request-line")
         resp = Response("400 BAD REQUEST", "text/plain", "You need a request-line!")
+        conn.should_close = True
         send_http_response(conn, resp)
-        return
+        return True
     request_line = lines[0] # first line is the request line
-    req.headers = lines[1:] # remaining lines are the headers
+    req.headers = [ hdr.decode("latin-1") for hdr in lines[1:] ] # remaining lines are the headers
+
+    # Parse the headers once into a dict, so lookups don't need to search.
+    header_map = req.header_map
+    for hdr in req.headers:
+        key, _, val = hdr.partition(":")
+        key = key.strip().lower()
+        if key not in header_map: # if repeated, first one wins
+            header_map[key] = val.strip()
 
     # The request-line can be further split into method, path, and version.
     words = request_line.split()
     if len(words) != 3:
-        log("The request-line is malformed: '%s'" % (request_line))
+        log("The request-line is malformed: '%s'" % (make_printable(request_line)))
         resp = Response("400 BAD REQUEST", "text/plain", "Your request-line is malformed!")
+        conn.should_close = True
         send_http_response(conn, resp)
-        return
-    req.method = words[0]
-    req.path = words[1]
-    req.version = words[2]
+        return True
+    req.method = words[0].decode("latin-1")
+    req.path = words[1].decode(errors="replace") # paths are utf-8, not latin-1
+    req.version = words[2].decode("latin-1")
 
     log("Request has method=%s, path=%s, version=%s, and %d headers" % (
         req.method, req.path, req.version, len(req.headers)))
@@ -371,20 +492,59 @@ def handle_one_http_request(conn):
     else:
         req.path = urllib.parse.unquote(req.path)
 
+    # HTTP/1.1 clients keep the connection open for more requests, unless they
+    # send "Connection: close". HTTP/1.0 clients close the connection after one
+    # request, unless they send "Connection: keep-alive", in which case the
+    # response must also say "Connection: keep-alive", or else the client will
+    # assume the connection is going to be closed. For any other version, we
+    # don't know the rules, so the connection is closed.
+    options = get_header_value(req, "Connection")
+    if options is None:
+        options = []
+    else:
+        options = [ opt.strip() for opt in options.lower().split(",") ]
+    conn.keep_alive_header = False
+    if req.version == "HTTP/1.0":
+        if "keep-alive" in options:
+            conn.keep_alive_header = True
+        else:
+            conn.should_close = True
+    elif req.version != "HTTP/1.1":
+        conn.should_close = True
+    elif "close" in options:
+        conn.should_close = True
+
+    # Any Transfer-Encoding means we can't tell where the request body ends, so
+    # whatever follows can't be trusted to be the start of the next request.
+    encoding = get_header_value(req, "Transfer-Encoding")
+    if encoding is not None:
+        conn.should_close = True
+
     # Browsers that use chunked transfer encoding are tricky, don't bother.
-    if get_header_value(req.headers, "Transfer-Encoding") == "chunked":
+    if encoding is not None and "chunked" in encoding.lower():
         log("The request uses chunked transfer encoding, which isn't yet supported")
         resp = Response("411 LENGTH REQUIRED",
                         "text/plain",
                         "Your request uses chunked transfer encoding, sorry!")
         send_http_response(conn, resp)
-        return
+        return True
 
     # If request has a Content-Length header, get the body of the request.
-    n = get_header_value(req.headers, "Content-Length")
+    n = get_header_value(req, "Content-Length")
     if n is not None:
+        if not (n.isascii() and n.isdigit()):
+            log("The request has an invalid Content-Length: '%s'", n)
+            resp = Response("400 BAD REQUEST", "text/plain",
+                            "Your Content-Length is invalid!")
+            conn.should_close = True # we can't tell where the body ends
+            send_http_response(conn, resp)
+            return True
         req.length = int(n)
-        req.body = conn.read_amount(int(n))
+        req.body = conn.read_amount(req.length)
+        if req.body is None:
+            # Client disconnected before sending the whole body.
+            log("Request body is incomplete, closing connection.")
+            return False # caller will close socket
 
     # Finally, look at the method and path to decide what to do.
     if req.method == "GET":
@@ -402,7 +562,35 @@ def handle_one_http_request(conn):
 
     # Now send the response to the client.
     send_http_response(conn, resp)
-
+    return True
+
+
+# http_date() returns the current time, formatted as needed for the HTTP "Date"
+# header, e.g. b"Tue, 15 Oct 2024 14:30:00 GMT", as a bytes object. The result
+# only changes once per second, so the most recent one is cached and reused. The
+# cache is a (seconds, bytes) tuple that is replaced all at once, so threads can
+# safely use it without needing a lock.
+date_cache = (0, b"")
+def http_date():
+    global date_cache
+    now = int(time.time())
+    cached = date_cache
+    if cached[0] != now:
+        cached = (now, time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(now)).encode())
+        date_cache = cached
+    return cached[1]
+
+# Every response starts with the same few lines, differing only in the response
+# code and the date. For the common response codes, the part before the date is
+# prepared once, here, so it doesn't need to be put together for each response.
+STATUS_PREFIXES = {}
+for code in [ "200 OK", "400 BAD REQUEST", "403 FORBIDDEN", "404 NOT FOUND",
+        "405 METHOD NOT ALLOWED", "411 LENGTH REQUIRED" ]:
+    STATUS_PREFIXES[code] = ("HTTP/1.1 " + code + "\r\nServer: csci356\r\nDate: ").encode()
+
+# Response bodies up to this size are combined with the headers and sent all at
+# once. Larger bodies are sent separately.
+COMBINED_SEND_MAX_BYTES = 64*1024
 
 # send_http_response() sends an HTTP response to the client. The response code
 # should be something like "200 OK" or "404 NOT FOUND". The mime_type and body
@@ -410,22 +598,33 @@ def handle_one_http_request(conn):
 def send_http_response(conn, resp):
     # If this is anything other than code 200, tally it as an error.
     if not resp.code.startswith("200 "):
-        with stats.lock: # update overall server statistics
+        with stats.errors_lock: # update overall server statistics
             stats.num_errors += 1
-    # Make a response-line and all the necessary headers.
-    data = "HTTP/1.1 " + resp.code + "\r\n"
-    data += "Server: csci356\r\n"
-    data += "Date: " + time.strftime("%a, %d %b %Y %H:%M:%S %Z", time.gmtime(time.time())) + "\r\n"
+    # Make a response-line and all the necessary headers. These are collected
+    # as a list of bytes objects, then joined together all at once at the end,
+    # rather than building up a string piece by piece.
+    prefix = STATUS_PREFIXES.get(resp.code)
+    if prefix is None:
+        prefix = ("HTTP/1.1 " + resp.code + "\r\nServer: csci356\r\nDate: ").encode()
+    parts = [ prefix, http_date(), b"\r\n" ]
+    if conn.should_close:
+        parts.append(b"Connection: close\r\n")
+    elif conn.keep_alive_header:
+        parts.append(b"Connection: keep-alive\r\n")
 
     if resp.cookies != None:
         # set cookies to expire in 1 week
-        expiration = time.strftime("%a, %d %b %Y %H:%M:%S %Z", time.gmtime(time.time() + 7*24*60*60))
+        expiration = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 7*24*60*60)).encode()
         for cookie in resp.cookies:
-            data += "Set-Cookie: " + cookie + "; Expires=" + expiration + "\r\n" 
+            parts += [ b"Set-Cookie: ", cookie.encode(), b"; Expires=", expiration, b"\r\n" ]
 
     body = None
     if resp.mime_type == None:
-        data += "Content-Length: 0\r\n"
+        parts.append(b"Content-Length: 0\r\n")
+    elif resp.send_as_file:                # if response body is an open file...
+        file_size = os.fstat(resp.body.fileno()).st_size
+        parts += [ b"Content-Type: ", resp.mime_type.encode(),
+                b"\r\nContent-Length: ", str(file_size).encode(), b"\r\n" ]
     else:
         if isinstance(resp.body, bytes):   # if response body is raw binary...
             body = resp.body               # ... no need to encode it
@@ -433,21 +632,73 @@ def send_http_response(conn, resp):
             body = resp.body.encode()      # ... convert to raw binary
         else:                              # if response body is anything else...
             body = str(resp.body).encode() # ... convert it to raw binary
-        data += "Content-Type: " + resp.mime_type + "\r\n"
-        data += "Content-Length: " + str(len(body)) + "\r\n"
-
-    data += "\r\n"
-
-    # Send response-line, headers, and body
-    log("Sending response-line and headers...\n%s" % (make_printable(data)))
-    conn.sock.sendall(data.encode())
-    if body is not None:
-        log("Response body (not shown) has %d bytes, mime type '%s'" %
-            (len(body), resp.mime_type))
-        # If you want to see the body in the console, uncomment this next line
-        log("\n====BEGIN BODY====\n" + make_printable(body) + "=====END BODY====")
-        conn.sock.sendall(body)
-
+        parts += [ b"Content-Type: ", resp.mime_type.encode(),
+                b"\r\nContent-Length: ", str(len(body)).encode(), b"\r\n" ]
+
+    parts.append(b"\r\n")
+    data = b"".join(parts)
+
+    # Send response-line, headers, and body. The timeout stops a client that
+    # isn't reading the response from tying up this worker thread forever. If
+    # the timeout (or any other error) happens part way through, the client
+    # can't get a complete response, so the connection must be closed.
+    if LOG_LEVEL >= 1:
+        log("Sending response-line and headers...\n%s", make_printable(data))
+    try:
+        if SOCKET_TIMEOUT is not None:
+            conn.sock.settimeout(SOCKET_TIMEOUT)
+        if resp.send_as_file:
+            conn.sock.sendall(data)
+            log("Response body is a file with %d bytes, mime type '%s'",
+                file_size, resp.mime_type)
+            # The sendfile() function has the operating system copy the file
+            # contents directly to the socket, so the data never needs to be
+            # read into python at all. Where that isn't possible, it falls back
+            # to reading and sending the file a piece at a time. Exactly
+            # file_size bytes are sent, to match the Content-Length header, even
+            # if the file changes in the meantime.
+            sent = conn.sock.sendfile(resp.body, 0, file_size)
+            if sent < file_size:
+                # The file shrank, so the client won't get all the bytes it
+                # expects. The only way to tell the client is to close the
+                # connection.
+                log("File shrank while being sent, only %d bytes were sent", sent)
+                conn.should_close = True
+        elif body is not None:
+            log("Response body has %d bytes, mime type '%s'",
+                len(body), resp.mime_type)
+            # If you want to see the body in the console, set LOG_LEVEL to 2
+            if LOG_LEVEL >= 2:
+                log("\n====BEGIN BODY====\n%s=====END BODY====",
+                    make_printable(body), level=2)
+            # Small bodies are sent along with the headers, using a single call
+            # to sendall(), to avoid the cost of an extra system call and
+            # possibly an extra network packet. Large bodies are sent
+            # separately, to avoid the cost of copying them, and a piece at a
+            # time, since the timeout limits how long each sendall() can take
+            # and a slow but steady client should still get the whole body.
+            if len(body) <= COMBINED_SEND_MAX_BYTES:
+                conn.sock.sendall(data + body)
+            else:
+                conn.sock.sendall(data)
+                view = memoryview(body)
+                for i in range(0, len(body), COMBINED_SEND_MAX_BYTES):
+                    conn.sock.sendall(view[i:i+COMBINED_SEND_MAX_BYTES])
+        else:
+            conn.sock.sendall(data)
+    except OSError as err:
+        if isinstance(err, socket.timeout):
+            log("Client %s has not accepted data in %s seconds.",
+                conn.client_addr, SOCKET_TIMEOUT)
+        else:
+            log("Error writing to client %s socket: %s", conn.client_addr, err)
+        conn.should_close = True
+    finally:
+        if resp.send_as_file:
+            resp.body.close()
+        # Remove timeout, if present, so future operations are unaffected.
+        if SOCKET_TIMEOUT is not None:
+            conn.sock.settimeout(None)
 
 # handle_http_get_status() returns a response for GET /status
 def handle_http_get_status(conn):
@@ -455,7 +706,7 @@ def handle_http_get_status(conn):
     msg = "Web server for csci 356, version 0.1\n"
     msg += "\n"
     msg += "Server Statistics:\n"
-    with stats.lock:
+    with stats.conn_lock, stats.lock, stats.errors_lock:
         msg += str(stats.total_connections) + " connections in total\n"
         msg += str(stats.active_connections) + " active connections\n"
         msg += str(stats.num_requests) + " requests handled\n"
@@ -465,7 +716,7 @@ def handle_http_get_status(conn):
     msg += "\n"
     msg += "Connection Statistics:\n"
     msg += str(conn.num_requests) + " requests handled on this connection so far\n"
-    msg +=  "%.3f s elapsed since start of this connection\n" % (time.time() - conn.start_time)
+    msg +=  "%.3f s elapsed since start of this connection\n" % (time.monotonic() - conn.start_time)
     return Response("200 OK", "text/plain", msg)
 
 
@@ -494,57 +745,163 @@ def handle_http_get_hello(req, conn):
     resp = Response("200 OK", "text/plain", msg)
     return resp
 
+# load_quotes() returns the list of quotes from the quotations.txt file. The
+# file is only read and split up the first time this is called, after that the
+# same list is returned every time. The lock is only needed for that first
+# time, so two threads don't both load the file. Once quotes is set it never
+# changes again, so it can be returned without taking the lock.
+quotes = None
+quotes_lock = threading.Lock() # protects the quotes variable, until it is set
+def load_quotes():
+    global quotes
+    if quotes is not None:
+        return quotes
+    with quotes_lock:
+        if quotes is None:
+            with open('quotations.txt') as f:
+                quotes = re.split('(?m)^%$', f.read())
+        return quotes
+
+# The parts of the /quote page that never change.
+QUOTE_PAGE_HEAD = ('<html><head><title>Quotes!</title></head>'
+    '<body>'
+    '<p>Here is a randomly generated quote from'
+    '  <a href="https://www.cs.cmu.edu/~pattis/quotations.html">Richard Pattis\' page</a> at CMU.'
+    '<pre>')
+QUOTE_PAGE_TAIL = ('</pre>'
+    '<p>Hit page refresh (F5) or <a href="/quote">click here</a> to refresh this page.</p>'
+    '<p>You can also check the <a href="/status">server status</a>, '
+    '  a <a href="/index.html">copy of the Holy Cross home page or something</a>, '
+    '</body></html>')
+
 # handle_http_get_quote() returns a response for the GET /quote
 def handle_http_get_quote():
     log("Handling http get quote request")
-    with open('quotations.txt') as f:
-        quotes = re.split('(?m)^%$', f.read())
-    msg = '<html><head><title>Quotes!</title></head>'
-    msg += '<body>'
-    msg += '<p>Here is a randomly generated quote from'
-    msg += '  <a href="https://www.cs.cmu.edu/~pattis/quotations.html">Richard Pattis\' page</a> at CMU.'
-    msg += "<pre>%s</pre>" % (random.choice(quotes))
-    msg += '<p>Hit page refresh (F5) or <a href="/quote">click here</a> to refresh this page.</p>'
-    msg += '<p>You can also check the <a href="/status">server status</a>, '
-    msg += '  a <a href="/index.html">copy of the Holy Cross home page or something</a>, '
-    msg += '</body></html>'
+    msg = QUOTE_PAGE_HEAD + random.choice(load_quotes()) + QUOTE_PAGE_TAIL
     return Response("200 OK", "text/html", msg)
 
 
+# FileCache objects hold in-memory copies of recently requested files, so that
+# popular files (like html, css, and image files) don't need to be read from
+# disk for every request. Each entry maps a url path to a (file path, file id,
+# mime type, file contents) tuple, where the file path is the real path that the
+# url path was found to refer to, and the file id is a (device, inode,
+# modification time) tuple identifying that file and its version. An entry
+# should only be used if the url path still leads to the same file, unmodified
+# since it was read, but it is up to the caller to check that. Entries are kept
+# in least-recently-used order, and the oldest entries are discarded whenever
+# the total size of the cached contents goes above max_bytes. The lock is only
+# held while the dict is examined or changed, never while reading a file.
+class FileCache:
+    def __init__(self, max_bytes):
+        self.lock = threading.Lock()             # protects all variables below
+        self.entries = collections.OrderedDict() # url path -> (file_path, file_id, mime_type, data)
+        self.total_bytes = 0                     # total size of all cached data
+        self.max_bytes = max_bytes               # limit for total_bytes
+
+    # lookup() returns the (file_path, file_id, mime_type, data) tuple for the
+    # given url path, or None if there is no copy of that file in the cache.
+    def lookup(self, url_path):
+        with self.lock:
+            entry = self.entries.get(url_path)
+            if entry is not None:
+                self.entries.move_to_end(url_path) # mark as most recently used
+            return entry
+
+    # insert() adds (or replaces) a cached copy of the given file, then discards
+    # the least recently used entries until the cache is back under its limit.
+    def insert(self, url_path, file_path, file_id, mime_type, data):
+        with self.lock:
+            old = self.entries.pop(url_path, None)
+            if old is not None:
+                self.total_bytes -= len(old[3])
+            self.entries[url_path] = (file_path, file_id, mime_type, data)
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.total_bytes -= len(old[3])
+
+# These variables control how much memory is used for caching files. Files
+# larger than FILE_CACHE_MAX_FILE_SIZE are never cached, and are instead always
+# sent directly from disk.
+FILE_CACHE_MAX_BYTES = 64*1024*1024   # 64 MB in total
+FILE_CACHE_MAX_FILE_SIZE = 1024*1024  # 1 MB per file
+file_cache = FileCache(FILE_CACHE_MAX_BYTES)
+
 # handle_http_get_file() returns an appropriate response for a GET request that
 # seems to be for a file, rather than a special URL. If the file can't be found,
 # or if there are any problems, an error response is generated.
 def handle_http_get_file(url_path):
     log("Handling http get file request, for "+ url_path)
-    
-    file_path = server_root + url_path
+
+    # File names can't contain a null character, and the os.path functions
+    # raise an error if asked about one, so there is no such file.
+    if "\x00" in url_path:
+        log("File was not found: " + make_printable(url_path))
+        return Response("404 NOT FOUND", "text/plain", "No such file: " + url_path)
+
+    # If this url path was cached earlier, the cache also remembers which file
+    # it refers to, and that file already passed all of the security precautions
+    # below, so they don't need to be repeated. The cached copy is used as long
+    # as the url path still leads to that same file (os.stat() follows any
+    # symbolic links along the way), and the file hasn't been modified since.
+    cached = file_cache.lookup(url_path)
+    if cached is not None:
+        (file_path, file_id, mime_type, data) = cached
+        try:
+            st = os.stat(server_root_abs + url_path.lstrip("/"))
+            if (st.st_dev, st.st_ino, st.st_mtime_ns) == file_id:
+                log("Using cached copy of file " + file_path)
+                return Response("200 OK", mime_type, data)
+        except OSError:
+            pass # the file is gone, so carry on as if it wasn't cached
 
     # There is a very real security risk that the requested file_path could
     # include things like "..", allowing a malicious or curious client to access
     # files outside of the server's web_root directory. We take several
     # precautions here to make sure that there is no funny business going on.
 
-    # First security precaution: "normalize" to eliminate ".." elements
-    file_path = os.path.normpath(file_path)
+    # First security precaution: get the "real" absolute path, eliminating ".."
+    # elements and following any symbolic links
+    file_path = os.path.realpath(server_root_abs + url_path.lstrip("/"))
 
-    # Second security precaution: make sure the requested file is in server_root
-    if os.path.commonprefix([file_path, server_root]) != server_root:
+    # Second security precaution: make sure the requested file is in server_root.
+    # Comparing whole directory names, each ending in a slash, ensures something
+    # like "/home/web_root_private/" isn't mistaken as being in "/home/web_root/".
+    if not (file_path + os.sep).startswith(server_root_abs):
         log("Path traversal attack detected: " + url_path)
         return Response("403 FORBIDDEN", "text/plain", "Permission denied: " + url_path)
 
-    # Third security precaution: check if the path is actually a file
-    if not os.path.isfile(file_path):
+    # Third security precaution: check if the path is actually a file. The same
+    # os.stat() results are used below for the file's size and modification time.
+    try:
+        file_info = os.stat(file_path)
+    except OSError:
+        file_info = None
+    if file_info is None or not stat.S_ISREG(file_info.st_mode):
         log("File was not found: " + file_path)
         return Response("404 NOT FOUND", "text/plain", "No such file: " + url_path)
 
-    # Finally, attempt to read data from the file, and return it
+    # Finally, attempt to get the file contents, and return them. Small files
+    # are read into memory and cached. For larger files, the contents are not
+    # read here, send_http_response() will send the file directly, so memory use
+    # stays small no matter how large the file is.
     try:
-        with open(file_path, "rb") as f: # "rb" mode means read "raw bytes"
-            data = f.read()
-        mime_type = "text/html" # oops, this is wrong
-        return Response("200 OK", mime_type, data)
-    except:
-        log("Error encountered reading from file")
+        mime_type = mimetypes.guess_type(file_path)[0]
+        if mime_type is None:
+            mime_type = "application/octet-stream"
+        f = open(file_path, "rb") # "rb" mode means read "raw bytes"
+        if file_info.st_size <= FILE_CACHE_MAX_FILE_SIZE:
+            with f:
+                data = f.read(file_info.st_size) # in case the file has grown
+            file_id = (file_info.st_dev, file_info.st_ino, file_info.st_mtime_ns)
+            file_cache.insert(url_path, file_path, file_id, mime_type, data)
+            return Response("200 OK", mime_type, data)
+        resp = Response("200 OK", mime_type, f)
+        resp.send_as_file = True
+        return resp
+    except OSError as err:
+        log("Error encountered reading from file: %s", err)
         return Response("403 FORBIDDEN", "text/plain", "Permission denied: " + url_path)
 
 
@@ -564,35 +921,75 @@ def handle_http_get(req, conn):
 # handle_http_connection() reads one or more HTTP requests from a client, parses
 # each one, and sends back appropriate responses to the client.
 def handle_http_connection(conn):
-    with stats.lock: # update overall server statistics
+    with stats.conn_lock: # update overall server statistics
         stats.active_connections += 1
     log("Handling connection from " + str(conn.client_addr))
     try:
-        # Process one HTTP request from client
-        start = time.time()
-        handle_one_http_request(conn)
-        end = time.time()
-        duration = end - start
-
-        # Do end-of-request statistics and cleanup
-        conn.num_requests += 1 # counter for this connection
-        log("Done handling request %d from %s" % (conn.num_requests, conn.client_addr))
-        with stats.lock: # update overall server statistics
-            stats.num_requests += 1
-            stats.tot_time = stats.tot_time + duration
-            stats.avg_time = stats.tot_time / stats.num_requests
-            if duration > stats.max_time:
-                stats.max_time = duration
+        # Process HTTP requests from client, until one of them asks to close
+        # the connection, or the client goes quiet.
+        while not conn.should_close:
+            # Wait a limited time for the next request (including the first
+            # one), so idle connections get closed and free up this worker.
+            if conn.wait_until_data_arrives(KEEP_ALIVE_TIMEOUT) is not None:
+                break
+
+            # Process one HTTP request from client
+            start = time.monotonic()
+            if not handle_one_http_request(conn):
+                break
+            end = time.monotonic()
+            duration = end - start
+            conn.last_active_time = end
+
+            # Do end-of-request statistics and cleanup
+            conn.num_requests += 1 # counter for this connection
+            log("Done handling request %d from %s" % (conn.num_requests, conn.client_addr))
+            with stats.lock: # update overall server statistics
+                stats.num_requests += 1
+                stats.tot_time = stats.tot_time + duration
+                stats.avg_time = stats.tot_time / stats.num_requests
+                if duration > stats.max_time:
+                    stats.max_time = duration
     finally:
         conn.sock.close()
         log("Done with connection from " + str(conn.client_addr))
-        with stats.lock: # update overall server statistics
+        with stats.conn_lock: # update overall server statistics
             stats.active_connections -= 1
 
 
+# This variable controls how many worker threads are used to handle
+# connections. Each worker handles one connection at a time, so this is also
+# the maximum number of connections that can be handled concurrently. Any other
+# connections will wait in a queue until a worker thread becomes available.
+# The trade-off, compared to starting a new thread for every connection, is that
+# a worker stays busy while its client is idle, so if that many clients connect
+# and then send nothing, or stop reading the responses sent to them, other
+# clients must wait until those connections time out. That is why
+# KEEP_ALIVE_TIMEOUT and SOCKET_TIMEOUT must not be None: they limit how long
+# the server waits for a client to send a request, and how long it waits for a
+# client to accept each part of a response.
+NUM_WORKER_THREADS = 64
+
+# Connections that have been accepted, but not yet handled by a worker thread.
+pending_connections = queue.Queue()
+
+# handle_pending_connections() is run by each worker thread. It repeatedly takes
+# a connection from the queue of pending connections and handles it. Creating
+# the worker threads once, when the server starts, avoids the cost of starting
+# a brand new thread for each connection.
+def handle_pending_connections():
+    while True:
+        conn = pending_connections.get()
+        try:
+            handle_http_connection(conn)
+        except Exception as err:
+            # Keep this worker thread alive, so it can handle other connections.
+            log("Error handling connection from %s: %s" % (conn.client_addr, err))
+
+
 # This remainder of this file is the main program, which listens on a server
-# socket for incoming connections from clients, and starts a handler thread for
-# each one.
+# socket for incoming connections from clients, and hands each one off to a pool
+# of worker threads.
 
 # Get command-line parameters
 if len(sys.argv) not in [3, 4]:
@@ -615,6 +1012,8 @@ if len(sys.argv) >= 4:
 
 # Ensure root path has a slash at the end
 server_root = os.path.normpath(server_root + '/')
+# Using join() with "" adds a slash at the end, unless there already is one
+server_root_abs = os.path.join(os.path.realpath(server_root), "")
 
 # Determine the IP address for listening
 if isTypicalIPv4Address(server_host):
@@ -623,12 +1022,20 @@ else:
     try:
         short_name = server_host.split('.')[0]
         server_ip = socket.gethostbyname(short_name)
-    except:
+    except OSError:
         print("Could not determine IP address for listening.")
         sys.exit(1)
 
 
 
+# Start the logging thread
+log_thread = threading.Thread(target=print_log_messages, name="Logger")
+log_thread.daemon = True
+log_thread.start()
+# However the program ends, even if it is due to an error, stop the logging
+# thread first, so no messages are lost.
+atexit.register(stop_logging)
+
 # Print a welcome message
 log("Starting web server.")
 log(f"Serving files from directory {server_root}")
@@ -645,23 +1052,30 @@ log("Server can be accessed at URLs such as:")
 log(f"    http://{server_host}:{server_port}/")
 log(f"    http://{server_host}:{server_port}/welcome.html")
 log(f"    http://{server_host}:{server_port}/status.html")
+
+# Start the worker threads
+for i in range(NUM_WORKER_THREADS):
+    t = threading.Thread(target=handle_pending_connections, name="Worker-%d" % (i+1))
+    t.daemon = True
+    t.start()
+
 log("Ready for connections...")
 
 try:
     # Repeatedly accept and handle connections
     while True:
         sock, client_addr = s.accept()
+        # Send responses right away, rather than waiting to combine them with
+        # more data (we already combine the headers and body ourselves).
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         # A new client socket connection has been accepted. Count it.
-        with stats.lock:
+        with stats.conn_lock:
             stats.total_connections += 1
         # Put the info into a Connection object.
-        conn = Connection(sock, client_addr)
-        # Start a thread to handle the new connection.
-        t = threading.Thread(target=handle_http_connection, args=(conn,))
-        t.daemon = True
-        t.start()
+        conn = Connection(sock, client_addr, time.monotonic())
+        # Queue it up, so a worker thread will handle the new connection.
+        pending_connections.put(conn)
 finally:
     log("Shutting down...")
     s.close()
-
-log("Done")
+    log("Done")